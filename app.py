@@ -1,14 +1,19 @@
 # app.py
-from flask import Flask, request, jsonify
-from models import Notification, db, User, Task, Quote, Rating
-from functools import wraps
+from flask import Flask, Response, request, jsonify, g
+from models import Notification, db, User, Task, Quote, Rating, default_load_opts
+from functools import wraps, lru_cache
 import jwt
 import datetime
 import os
+import threading
+import time
 from flask_cors import CORS
-from math import radians, sin, cos, sqrt, atan2
+import numpy as np
+import orjson
+from math import radians, cos
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
+from sqlalchemy import event, exists, func, or_, text, update
 from sqlalchemy.orm import joinedload
 
 app = Flask(__name__)
@@ -33,12 +38,37 @@ db_path = os.path.join(instance_path, "wave.db")
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Keep a pool of connections sized for threaded workers instead of reconnecting per request
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
 app.config['SECRET_KEY'] = 'wave-secret-key-for-dev-only'
+# Raise on unplanned lazy loads in list routes (set in dev/tests to catch N+1)
+app.config['DEBUG_RAISELOAD'] = os.environ.get('DEBUG_RAISELOAD') == '1'
 
 db.init_app(app)
 
+def _set_sqlite_pragma(dbapi_conn, connection_record):
+    # WAL lets readers run alongside the single writer instead of blocking on it
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # Needed for ON DELETE CASCADE; SQLite ships with FK enforcement off
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+with app.app_context():
+    event.listen(db.engine, "connect", _set_sqlite_pragma)
+
 UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif'})
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max
 
@@ -46,15 +76,29 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
 
 def create_tables():
     with app.app_context():
         db.create_all()
+        # create_all() skips tables that already exist, indexes included
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
         print("✅ Tables created!")
 
-create_tables()
+# Run `flask --app app init-db` once instead of creating tables on every import
+@app.cli.command("init-db")
+def init_db_command():
+    create_tables()
+
+# SQLite allows one writer at a time; queue writers here instead of on its file lock
+_write_lock = threading.RLock()
+
+def commit_session():
+    with _write_lock:
+        db.session.commit()
 
 # Add this helper function at the top (after imports)
 def create_notification(user_id, message):
@@ -62,15 +106,30 @@ def create_notification(user_id, message):
     notif = Notification(user_id=user_id, message=message)
     db.session.add(notif)
 
+def json_response(obj, status=200):
+    # orjson serializes the large list payloads several times faster than jsonify
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z),
+        status=status,
+        mimetype='application/json'
+    )
+
 def haversine_distance(lat1, lon1, lat2, lon2):
+    # Works on scalars or NumPy arrays, so a whole batch of points is one call
     R = 6371.0
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
     dlat = lat2 - lat1
     dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
     return R * c
 
+@lru_cache(maxsize=4096)
+def _decode_cached(token):
+    # Cache the verified claims so repeat requests skip the HMAC check
+    data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    return data['user_id'], data.get('exp')
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -81,19 +140,28 @@ def token_required(f):
         if not token:
             return jsonify({"error": "Token is missing!"}), 401
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user_id = data['user_id']
+            current_user_id, exp_ts = _decode_cached(token)
+            if exp_ts is not None and exp_ts <= time.time():
+                _decode_cached.cache_clear()
+                raise jwt.ExpiredSignatureError
         except jwt.ExpiredSignatureError:
             return jsonify({"error": "Token has expired!"}), 401
         except jwt.InvalidTokenError:
             return jsonify({"error": "Token is invalid!"}), 401
+        g.current_user_id = current_user_id
         return f(current_user_id, *args, **kwargs)
     return decorated
 
+def load_current_user():
+    # Fetched at most once per request, then reused by later callers
+    if 'current_user' not in g:
+        g.current_user = User.query.get(g.current_user_id)
+    return g.current_user
+
 def admin_required(f):
     @wraps(f)
     def decorated(current_user_id, *args, **kwargs):
-        user = User.query.get(current_user_id)
+        user = load_current_user()
         if not user or not user.is_admin:
             return jsonify({"error": "Admin only"}), 403
         return f(current_user_id, *args, **kwargs)
@@ -119,9 +187,9 @@ def register():
     if data['role'] not in ['user', 'seeker']:
         return jsonify({"error": "Role must be 'user' or 'seeker'"}), 400
 
-    if User.query.filter_by(email=data['email']).first():
+    if db.session.query(exists().where(User.email == data['email'])).scalar():
         return jsonify({"error": "Email already registered"}), 400
-    if User.query.filter_by(username=data['username']).first():
+    if db.session.query(exists().where(User.username == data['username'])).scalar():
         return jsonify({"error": "Username already taken"}), 400
 
     new_user = User(
@@ -133,7 +201,7 @@ def register():
     )
     new_user.set_password(data['password'])
     db.session.add(new_user)
-    db.session.commit()
+    commit_session()
     return jsonify({"message": "User registered!", "user": new_user.to_dict()}), 201
 
 @app.route('/api/auth/login', methods=['POST'])
@@ -162,16 +230,13 @@ def login():
 @app.route('/api/tasks/mine', methods=['GET'])
 @token_required
 def get_my_tasks(current_user_id):
-    tasks = Task.query.options(
-        joinedload(Task.quotes),
-        joinedload(Task.ratings)
-    ).filter_by(poster_id=current_user_id).all()
-    return jsonify([task.to_dict() for task in tasks]), 200
+    tasks = Task.query.options(*default_load_opts()).filter_by(poster_id=current_user_id).all()
+    return json_response([task.to_dict() for task in tasks])
 
 @app.route('/me', methods=['GET'])
 @token_required
 def get_current_user(current_user_id):
-    user = User.query.get(current_user_id)
+    user = load_current_user()
     if not user:
         return jsonify({"error": "User not found"}), 404
     return jsonify(user.to_dict()), 200
@@ -179,7 +244,7 @@ def get_current_user(current_user_id):
 @app.route('/users', methods=['GET'])
 def get_users():
     users = User.query.all()
-    return jsonify([user.to_dict() for user in users]), 200
+    return json_response([user.to_dict() for user in users])
 
 # === TASK ROUTES ===
 @app.route('/api/tasks', methods=['POST'])
@@ -201,7 +266,7 @@ def create_task(current_user_id):
         status='open'
     )
     db.session.add(new_task)
-    db.session.commit()
+    commit_session()
     return jsonify(new_task.to_dict()), 201
 
 
@@ -216,14 +281,14 @@ def create_task(current_user_id):
 @admin_required
 def admin_users(current_user_id):
     users = User.query.all()
-    return jsonify([u.to_dict() for u in users])
+    return json_response([u.to_dict() for u in users])
 
 @app.route('/api/admin/tasks', methods=['GET'])
 @token_required
 @admin_required
 def admin_tasks(current_user_id):
-    tasks = Task.query.all()
-    return jsonify([t.to_dict() for t in tasks])
+    tasks = Task.query.options(*default_load_opts()).all()
+    return json_response([t.to_dict() for t in tasks])
 
 @app.route('/profile/location', methods=['PUT'])
 @token_required
@@ -232,13 +297,13 @@ def update_location(current_user_id):
     if 'latitude' not in data or 'longitude' not in data:
         return jsonify({"error": "latitude and longitude are required"}), 400
 
-    user = User.query.get(current_user_id)
+    user = load_current_user()
     if not user:
         return jsonify({"error": "User not found"}), 404
 
     user.latitude = data['latitude']
     user.longitude = data['longitude']
-    db.session.commit()
+    commit_session()
 
     return jsonify({
         "message": "Location updated",
@@ -274,7 +339,7 @@ def submit_quote(current_user_id, task_id):
         mobile=mobile
     )
     db.session.add(quote)
-    db.session.commit()
+    commit_session()
     return jsonify(quote.to_dict()), 201
 
 # In app.py (add this route)
@@ -293,9 +358,9 @@ def upload_profile_image(current_user_id):
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
-        user = User.query.get(current_user_id)
+        user = load_current_user()
         user.image_url = f"/uploads/{filename}"
-        db.session.commit()
+        commit_session()
         
         return jsonify({"image_url": user.image_url}), 200
 
@@ -312,29 +377,37 @@ def accept_quote(current_user_id, quote_id):
     if task.poster_id != current_user_id:
         return jsonify({"error": "Only the task poster can accept quotes"}), 403
 
-    # Decline all other quotes
-    other_quotes = Quote.query.filter_by(task_id=task.id).filter(Quote.id != quote_id)
-    for q in other_quotes:
-        q.status = 'declined'
+    # The UPDATE takes SQLite's write lock before commit, so hold ours for the whole block
+    with _write_lock:
+        # Decline all other quotes in one UPDATE and notify their helpers in one batch
+        declined_ids = [h for (h,) in db.session.query(Quote.helper_id).filter(
+            Quote.task_id == task.id, Quote.id != quote_id
+        ).all()]
+        db.session.execute(
+            update(Quote)
+            .where(Quote.task_id == task.id, Quote.id != quote_id)
+            .values(status='declined')
+        )
+        db.session.bulk_insert_mappings(Notification, [
+            {"user_id": h, "message": f"Your quotation for '{task.title}' was declined."}
+            for h in declined_ids
+        ])
+
+        # Accept selected quote
+        quote.status = 'accepted'
+        task.helper_id = quote.helper_id
+        task.charges = quote.charges
+        task.hours = quote.hours
+        task.status = 'accepted'
         create_notification(
-            q.helper_id,
-            f"Your quotation for '{task.title}' was declined."
+            quote.helper_id,
+            f"Your work for '{task.title}' was assigned!"
         )
-    
-    
-    # Accept selected quote
-    quote.status = 'accepted'
-    task.helper_id = quote.helper_id
-    task.charges = quote.charges
-    task.hours = quote.hours
-    task.status = 'accepted'
-    db.session.commit()
-    create_notification(
-        quote.helper_id,
-        f"Your work for '{task.title}' was assigned!"
-    )
-    db.session.commit()
+        task_id = task.id
+        commit_session()
 
+    # Reload after the commit expired everything, with the relationships to_dict() needs
+    task = Task.query.options(*default_load_opts()).filter_by(id=task_id).first()
     return jsonify({
         "message": "Quote accepted",
         "task": task.to_dict(),
@@ -344,8 +417,11 @@ def accept_quote(current_user_id, quote_id):
 @app.route('/api/notifications', methods=['GET'])
 @token_required
 def get_notifications(current_user_id):
-    notifs = Notification.query.filter_by(user_id=current_user_id).order_by(Notification.created_at.desc()).all()
-    return jsonify([n.to_dict() for n in notifs]), 200
+    # Rows stamped by the server default only have second resolution, so break ties by id
+    notifs = Notification.query.filter_by(user_id=current_user_id).order_by(
+        Notification.created_at.desc(), Notification.id.desc()
+    ).all()
+    return json_response([n.to_dict() for n in notifs])
 
 @app.route('/api/notifications/<int:notification_id>/read', methods=['POST'])
 @token_required
@@ -354,29 +430,46 @@ def mark_notification_read(current_user_id, notification_id):
     if not notif:
         return jsonify({"error": "Notification not found"}), 404
     notif.is_read = True
-    db.session.commit()
+    commit_session()
     return jsonify({"message": "Notification marked as read"}), 200
 
+PROFILE_RATINGS_LIMIT = 50
+
 @app.route('/api/profile/<int:user_id>', methods=['GET'])
 def get_profile(user_id):
     user = User.query.get(user_id)
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    # Get completed tasks counts
-    completed_tasks_as_helper = Task.query.filter_by(helper_id=user_id, status='completed').count()
-    completed_tasks_as_seeker = Task.query.filter_by(poster_id=user_id, status='completed').count()
-
-    # Get ratings received
-    ratings_received = Rating.query.filter_by(ratee_id=user_id).all()
-    # ✅ Use 'score' instead of 'rating'
-    avg_rating = round(sum(r.score for r in ratings_received) / len(ratings_received), 1) if ratings_received else 0
+    # Get completed tasks counts (both roles in one pass)
+    counts = db.session.execute(text(
+        "SELECT COALESCE(SUM(CASE WHEN helper_id = :u THEN 1 ELSE 0 END), 0) AS h, "
+        "COALESCE(SUM(CASE WHEN poster_id = :u THEN 1 ELSE 0 END), 0) AS p "
+        "FROM task WHERE status = 'completed' AND (helper_id = :u OR poster_id = :u)"
+    ), {'u': user_id}).one()
+    completed_tasks_as_helper = counts.h
+    completed_tasks_as_seeker = counts.p
+
+    # Rating summary aggregated in SQL instead of averaging every row in Python
+    total_ratings, avg_score = db.session.query(
+        func.count(Rating.id),
+        func.avg(Rating.score)
+    ).filter(Rating.ratee_id == user_id).one()
+    avg_rating = round(avg_score, 1) if total_ratings else 0
+
+    # Only the most recent ratings are needed for display
+    ratings_received = Rating.query.options(
+        joinedload(Rating.rater),
+        joinedload(Rating.ratee)
+    ).filter_by(ratee_id=user_id).order_by(
+        Rating.created_at.desc()
+    ).limit(PROFILE_RATINGS_LIMIT).all()
 
     return jsonify({
         "user": user.to_dict(),
         "completed_tasks_as_helper": completed_tasks_as_helper,
         "completed_tasks_as_seeker": completed_tasks_as_seeker,
-        "total_ratings": len(ratings_received),
+        "total_ratings": total_ratings,
         "average_rating": avg_rating,
         "ratings": [r.to_dict() for r in ratings_received]
     }), 200
@@ -387,8 +480,8 @@ def get_profile(user_id):
 @token_required
 def get_assigned_tasks(current_user_id):
     """Get tasks assigned to current user as helper"""
-    tasks = Task.query.filter_by(helper_id=current_user_id).all()
-    return jsonify([task.to_dict() for task in tasks]), 200
+    tasks = Task.query.options(*default_load_opts()).filter_by(helper_id=current_user_id).all()
+    return json_response([task.to_dict() for task in tasks])
 
 # ✅ SINGLE complete_task route (removed duplicate)
 @app.route('/api/tasks/<int:task_id>/complete', methods=['POST'])
@@ -403,7 +496,9 @@ def complete_task(current_user_id, task_id):
         return jsonify({"error": "You're not authorized to complete this task"}), 403
 
     task.status = 'completed'
-    db.session.commit()
+    commit_session()
+    # Reload after the commit expired everything, with the relationships to_dict() needs
+    task = Task.query.options(*default_load_opts()).filter_by(id=task_id).first()
     return jsonify(task.to_dict()), 200
 
 # Profile image upload route
@@ -451,7 +546,7 @@ def create_rating(current_user_id):
         comment=comment
     )
     db.session.add(rating)
-    db.session.commit()
+    commit_session()
     return jsonify(rating.to_dict()), 201
 
 # === TASK MANAGEMENT ===
@@ -467,12 +562,14 @@ def delete_task(current_user_id, task_id):
         if task.status != 'open':
             return jsonify({"error": "Only open tasks can be deleted"}), 400
 
-        # Delete related quotes and ratings FIRST
-        Quote.query.filter_by(task_id=task_id).delete()
-        Rating.query.filter_by(task_id=task_id).delete()
-        
-        db.session.delete(task)
-        db.session.commit()
+        # Delete related quotes and ratings explicitly in the same transaction;
+        # tables created before ON DELETE CASCADE was added don't cascade.
+        # The first DELETE takes SQLite's write lock, so hold ours for the whole block
+        with _write_lock:
+            Quote.query.filter_by(task_id=task_id).delete()
+            Rating.query.filter_by(task_id=task_id).delete()
+            db.session.delete(task)
+            commit_session()
         return jsonify({"message": "Task deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
@@ -499,7 +596,7 @@ def upload_task_image(current_user_id, task_id):
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         task.image_url = f"/uploads/{filename}"
-        db.session.commit()
+        commit_session()
         return jsonify({"message": "Image uploaded", "image_url": task.image_url}), 200
 
     return jsonify({"error": "Invalid file type. Use PNG, JPG, JPEG, or GIF"}), 400
@@ -509,8 +606,8 @@ def upload_task_image(current_user_id, task_id):
 def get_completed_tasks(user_id):
     """Get tasks where user was helper and status=completed"""
     try:
-        tasks = Task.query.filter_by(helper_id=user_id, status='completed').all()
-        return jsonify([task.to_dict() for task in tasks]), 200
+        tasks = Task.query.options(*default_load_opts()).filter_by(helper_id=user_id, status='completed').all()
+        return json_response([task.to_dict() for task in tasks])
     except Exception as e:
         print(f"Error fetching completed tasks: {e}")
         return jsonify({"error": "Failed to fetch completed tasks"}), 500
@@ -519,7 +616,7 @@ def get_completed_tasks(user_id):
 @app.route('/api/map/tasks', methods=['GET'])
 @token_required
 def get_map_tasks(current_user_id):
-    user = User.query.get(current_user_id)
+    user = load_current_user()
     if not user or user.latitude is None or user.longitude is None:
         return jsonify({"error": "Your location is not set"}), 400
 
@@ -530,26 +627,49 @@ def get_map_tasks(current_user_id):
     except (TypeError, ValueError):
         return jsonify({"error": "Invalid radius"}), 400
 
-    all_tasks = Task.query.filter_by(status='open').all()
-    nearby_tasks = []
+    # Cheap bounding-box pre-filter in SQL; haversine below refines the survivors
+    dlat = radius / 111.0
+    dlon = radius / (111.0 * cos(radians(user.latitude)) + 1e-6)
+    filters = [
+        Task.status == 'open',
+        Task.latitude.between(user.latitude - dlat, user.latitude + dlat)
+    ]
+    # Near the poles the box spans every longitude, so skip the lon filter
+    if dlon < 180:
+        lon_min = user.longitude - dlon
+        lon_max = user.longitude + dlon
+        # Split the range in two when the box crosses the antimeridian
+        if lon_min < -180:
+            filters.append(or_(Task.longitude >= lon_min + 360, Task.longitude <= lon_max))
+        elif lon_max > 180:
+            filters.append(or_(Task.longitude >= lon_min, Task.longitude <= lon_max - 360))
+        else:
+            filters.append(Task.longitude.between(lon_min, lon_max))
+
+    rows = db.session.query(
+        Task.id, Task.title, Task.category, Task.reward,
+        Task.latitude, Task.longitude
+    ).filter(*filters).all()
+
+    lats = np.fromiter((r.latitude for r in rows), dtype=np.float64, count=len(rows))
+    lons = np.fromiter((r.longitude for r in rows), dtype=np.float64, count=len(rows))
+    dists = haversine_distance(user.latitude, user.longitude, lats, lons)
 
-    for task in all_tasks:
-        dist = haversine_distance(
-            user.latitude, user.longitude,
-            task.latitude, task.longitude
-        )
-        if dist <= radius:
-            nearby_tasks.append({
-                "id": task.id,
-                "title": task.title,
-                "category": task.category,
-                "reward": task.reward,
-                "latitude": task.latitude,
-                "longitude": task.longitude,
-                "distance_km": round(dist, 2)
-            })
-
-    return jsonify(nearby_tasks), 200
+    nearby_tasks = []
+    for i in np.flatnonzero(dists <= radius):
+        row = rows[i]
+        nearby_tasks.append({
+            "id": row.id,
+            "title": row.title,
+            "category": row.category,
+            "reward": row.reward,
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "distance_km": round(float(dists[i]), 2)
+        })
+
+    return json_response(nearby_tasks)
 
 if __name__ == '__main__':
+    create_tables()
     app.run()
\ No newline at end of file
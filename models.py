@@ -1,10 +1,26 @@
 # models.py
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, raiseload, selectinload
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+import hmac
+import secrets
+import time
 
 db = SQLAlchemy()
 
+# Werkzeug's current scrypt default, pinned so login cost doesn't drift across upgrades
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+
+# Recently verified (hash, HMAC(password)) pairs -> expiry timestamp. The HMAC
+# key is random per process, so the cache never holds a plain fast hash of a password.
+_MEMO_KEY = secrets.token_bytes(32)
+_verified_passwords = {}
+VERIFIED_PASSWORD_TTL = 60
+VERIFIED_PASSWORD_MAX = 2048
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -21,10 +37,21 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, default=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash:
+            return False
+        key = (self.password_hash, hmac.new(_MEMO_KEY, password.encode(), 'sha256').hexdigest())
+        now = time.time()
+        if _verified_passwords.get(key, 0) > now:
+            return True
+        if not check_password_hash(self.password_hash, password):
+            return False
+        if len(_verified_passwords) >= VERIFIED_PASSWORD_MAX:
+            _verified_passwords.clear()
+        _verified_passwords[key] = now + VERIFIED_PASSWORD_TTL
+        return True
 
     def to_dict(self):
         return {
@@ -42,15 +69,21 @@ class User(db.Model):
         }
 
 class Rating(db.Model):
+    __table_args__ = (
+        db.Index('ix_rating_ratee', 'ratee_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='CASCADE'), nullable=False)
     rater_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # who gave the rating
     ratee_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # who received the rating
     score = db.Column(db.Integer, nullable=False)  # 1 to 5
     comment = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    task = db.relationship('Task', backref=db.backref('ratings', lazy=True))
+    task = db.relationship('Task', backref=db.backref(
+        'ratings', lazy=True, cascade='all, delete-orphan', passive_deletes=True
+    ))
     rater = db.relationship('User', foreign_keys=[rater_id])
     ratee = db.relationship('User', foreign_keys=[ratee_id])
 
@@ -68,8 +101,12 @@ class Rating(db.Model):
         }
 
 class Quote(db.Model):
+    __table_args__ = (
+        db.Index('ix_quote_task_helper', 'task_id', 'helper_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='CASCADE'), nullable=False)
     helper_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     charges = db.Column(db.Float, nullable=False)
     hours = db.Column(db.Float, nullable=False)
@@ -77,7 +114,9 @@ class Quote(db.Model):
     status = db.Column(db.String(20), default="pending")  # pending, accepted, declined
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    task = db.relationship('Task', backref=db.backref('quotes', lazy=True))
+    task = db.relationship('Task', backref=db.backref(
+        'quotes', lazy=True, cascade='all, delete-orphan', passive_deletes=True
+    ))
     helper = db.relationship('User', foreign_keys=[helper_id])
 
     def to_dict(self):
@@ -94,11 +133,17 @@ class Quote(db.Model):
         }
 
 class Notification(db.Model):
+    __table_args__ = (
+        db.Index('ix_notif_user_created_desc', 'user_id', db.desc('created_at')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     message = db.Column(db.String(255), nullable=False)
     is_read = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Python default covers tables created before server_default was added,
+    # since create_all() never alters an existing column
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
 
     user = db.relationship('User', backref=db.backref('notifications', lazy=True))
 
@@ -112,6 +157,12 @@ class Notification(db.Model):
         }
 
 class Task(db.Model):
+    __table_args__ = (
+        db.Index('ix_task_status_lat_lon', 'status', 'latitude', 'longitude'),
+        db.Index('ix_task_poster_status', 'poster_id', 'status'),
+        db.Index('ix_task_helper_status', 'helper_id', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
@@ -149,3 +200,17 @@ class Task(db.Model):
         result["ratings"] = [r.to_dict() for r in self.ratings]
     
         return result
+
+def default_load_opts():
+    # Everything Task.to_dict() touches, loaded up front
+    opts = (
+        selectinload(Task.quotes).options(joinedload(Quote.helper)),
+        selectinload(Task.ratings).options(
+            joinedload(Rating.rater),
+            joinedload(Rating.ratee)
+        ),
+    )
+    # In dev/tests, any relationship not listed above raises instead of lazy-loading
+    if current_app.config.get('DEBUG_RAISELOAD'):
+        opts += (raiseload('*'),)
+    return opts